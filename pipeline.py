@@ -2,17 +2,24 @@
 Batch brush-event detector pipeline.
 
 For each video in --input-dir:
-  1. Convert to 1 FPS if needed (all frames preserved, no skipping)
-  2. Burn frame index (0-based) into top-right corner (temporary intermediate)
-  3. Upload labeled video to Gemini, detect brush-contact frame ranges (L / R)
-  4. Save JSON result  →  <output-dir>/<stem>/result.json
+  1. Convert to 1 FPS if needed (all frames preserved, no skipping) and burn
+     frame index (0-based) into top-right corner, in a single ffmpeg pass
+     (temporary intermediate)
+  2. Upload labeled video to Gemini, detect brush-contact frame ranges (L / R)
+     (with --batch-size N, up to N videos are concatenated into one labeled
+     video, clips labeled 'V{i}:Frame N', and detected in a single request)
+  3. Save JSON result  →  <output-dir>/<stem>/result.json
      L and R are [start, end] frame-index ranges, or null.
-  5. (optional --visualize) Save visualization video where the detected brush
+  4. (optional --visualize) Save visualization video where the detected brush
      range is highlighted in red  →  <output-dir>/<stem>/<stem>_vis.mp4
 
 Caching: if result.json already exists, Gemini detection is skipped.
          if <stem>_vis.mp4 already exists, visualization is skipped.
          Use --force to ignore existing results and reprocess everything.
+         At temperature 0, Gemini results are also cached by labeled-video
+         content under <output-dir>/.cache/, so reruns on unchanged videos
+         (e.g. after deleting result.json) skip the Gemini calls. --force
+         bypasses this cache too and refreshes it with the new answers.
 
 Usage:
   python pipeline.py \\
@@ -24,35 +31,46 @@ Usage:
 
 Requirements:
   pip install -U google-genai
+  pip install h2                  # optional: HTTP/2 connection multiplexing
+  pip install orjson              # optional: faster JSON parsing
   export GEMINI_API_KEY="YOUR_KEY"
 """
 
 from __future__ import annotations
 
 import argparse
+import collections
 import concurrent.futures
+import functools
+import hashlib
+import importlib.util
 import json
 import os
+import random
 import subprocess
 import sys
+import tempfile
+import threading
 import time
+from dataclasses import dataclass, field
 from fractions import Fraction
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Deque, Dict, List, Optional, Protocol, Tuple, Union
 
+import httpx
 from google import genai
 from google.genai import types
 
+try:
+    import orjson  # optional: faster JSON parsing / serialization
+except ImportError:
+    orjson = None
 
-# ── Prompt & response schema ───────────────────────────────────────────────────
 
-PROMPT_EN = """\
-You are analyzing a scientific experiment video.
-
-IMPORTANT: The video is stored at 1 FPS (one frame per second).
-Each frame displays its index number in the TOP-RIGHT CORNER (e.g. "Frame 0", "Frame 1", ...).
-Use those visible labels as the frame index — do NOT infer index from timestamps.
+# ── Prompt & response schema ───────────────────────────────────────────────────
 
+# Task description shared by the single-video and batched (--batch-size) prompts
+_PROMPT_TASK = """\
 There are two mice in the video:
 - L = the mouse on the LEFT side of the frame
 - R = the mouse on the RIGHT side of the frame
@@ -74,7 +92,16 @@ Validity rule — set the field to null and explain in notes if ANY of the follo
 - The mouse is brushed MORE THAN ONCE (2+ distinct brush contacts detected for that side).
 - You cannot confidently determine whether exactly one full brush-paw contact occurred.
 Do NOT guess. Only return a range when you are confident there is exactly one clear event.
+"""
 
+PROMPT_EN = """\
+You are analyzing a scientific experiment video.
+
+IMPORTANT: The video is stored at 1 FPS (one frame per second).
+Each frame displays its index number in the TOP-RIGHT CORNER (e.g. "Frame 0", "Frame 1", ...).
+Use those visible labels as the frame index — do NOT infer index from timestamps.
+
+""" + _PROMPT_TASK + """
 Return strictly valid JSON matching this schema:
 {
   "L": [start_frame, end_frame] or null,
@@ -83,6 +110,31 @@ Return strictly valid JSON matching this schema:
 }
 """
 
+PROMPT_BATCH_EN = """\
+You are analyzing a scientific experiment video made of several independent
+clips (separate experiment videos) played back to back.
+
+IMPORTANT: The video is stored at 1 FPS (one frame per second).
+Each frame displays its clip id and frame index in the TOP-RIGHT CORNER
+(e.g. "V0:Frame 0", "V0:Frame 1", ..., "V1:Frame 0", ...). The frame index restarts at 0 in every clip.
+Use those visible labels as the clip id and frame index — do NOT infer them from timestamps.
+Analyze every clip on its own: everything below applies to each clip separately, as if it were its own video.
+
+""" + _PROMPT_TASK + """
+Return strictly valid JSON matching this schema, with exactly one entry per clip:
+{
+  "results": [
+    {
+      "video_id": clip id (e.g. "V0"),
+      "L": [start_frame, end_frame] or null,
+      "R": [start_frame, end_frame] or null,
+      "notes": string
+    },
+    ...
+  ]
+}
+"""
+
 _RANGE_SCHEMA: Dict[str, Any] = {
     "type": "array",
     "items": {"type": "integer"},
@@ -109,62 +161,300 @@ RESPONSE_SCHEMA: Dict[str, Any] = {
     "required": ["L", "R", "notes"],
 }
 
+BATCH_RESPONSE_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "video_id": {"type": "string", "description": 'Clip id from the label, e.g. "V0".'},
+                    **RESPONSE_SCHEMA["properties"],
+                },
+                "required": ["video_id", "L", "R", "notes"],
+            },
+        },
+    },
+    "required": ["results"],
+}
+
+# Default (temperature 0) generation configs, built once and shared by every call
+_GEN_CFG = types.GenerateContentConfig(
+    temperature=0.0,
+    response_mime_type="application/json",
+    response_schema=RESPONSE_SCHEMA,
+)
+_GEN_CFG_BATCH = types.GenerateContentConfig(
+    temperature=0.0,
+    response_mime_type="application/json",
+    response_schema=BATCH_RESPONSE_SCHEMA,
+)
+
 VIDEO_EXTENSIONS = {".mp4", ".avi", ".mov", ".mkv", ".m4v"}
 
+
+def _json_loads(data: Union[str, bytes]) -> Any:
+    """Parse JSON with orjson when installed, else the stdlib json module."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(obj: Any, indent: bool = False) -> bytes:
+    """
+    Serialize obj to UTF-8 JSON bytes (non-ASCII kept as-is), with a 2-space
+    indent if requested. Uses orjson when installed, else the stdlib json module.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False).encode()
+
 # ── ffmpeg helpers ─────────────────────────────────────────────────────────────
 
 def _run_ffmpeg(args: List[str]) -> None:
-    result = subprocess.run(
-        ["ffmpeg", "-y"] + args,
-        stdout=subprocess.PIPE,
+    # -loglevel error keeps stderr nearly empty on success; only the last
+    # lines are kept (bounded memory, and the pipe is drained as ffmpeg runs).
+    proc = subprocess.Popen(
+        ["ffmpeg", "-y", "-nostats", "-loglevel", "error"] + args,
+        stdout=subprocess.DEVNULL,
         stderr=subprocess.PIPE,
+        text=True,
+        errors="replace",
     )
-    if result.returncode != 0:
-        raise RuntimeError(
-            f"ffmpeg failed:\n{result.stderr.decode(errors='replace')[-2000:]}"
-        )
+    tail: Deque[str] = collections.deque(maxlen=40)
+    for line in proc.stderr:
+        tail.append(line.rstrip("\n"))
+    if proc.wait() != 0:
+        raise RuntimeError("ffmpeg failed:\n" + "\n".join(tail))
 
 
-def _get_orig_fps(video_path: str) -> float:
+def _probe(video_path: str) -> Dict[str, Any]:
+    """
+    Return metadata of the first video stream from a single ffprobe call:
+    r_frame_rate (e.g. "30/1"), duration, width, height and codec_name.
+    """
     result = subprocess.run(
         [
             "ffprobe", "-v", "error",
             "-select_streams", "v:0",
-            "-show_entries", "stream=r_frame_rate",
-            "-of", "default=noprint_wrappers=1:nokey=1",
+            "-show_entries", "stream=r_frame_rate,duration,width,height,codec_name",
+            "-of", "json",
             video_path,
         ],
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
     )
-    fps_str = result.stdout.decode().strip()  # e.g. "30/1"
-    return float(Fraction(fps_str))
+    if result.returncode != 0:
+        raise RuntimeError(
+            f"ffprobe failed:\n{result.stderr.decode(errors='replace')[-2000:]}"
+        )
+    streams = _json_loads(result.stdout).get("streams") or []
+    if not streams:
+        raise RuntimeError(f"No video stream found in {video_path}")
+    return streams[0]
 
 
 # Base drawtext options shared by labeled and visualization renders.
 # %{n} is ffmpeg's frame-counter expansion (0-based).
-_DT_BASE = (
-    "drawtext=text='Frame %{n}'"
+_DT_STYLE = (
     ":start_number=0"
     ":x=W-tw-20:y=20"
     ":fontsize=48"
     ":box=1:boxcolor=black@0.6:boxborderw=8"
 )
+_DT_BASE = "drawtext=text='Frame %{n}'" + _DT_STYLE
+
+# H.264 encoder settings. "fast" is for the labeled upload: Gemini only needs
+# to read the frame labels, so trade quality for speed. "default" keeps the
+# encoder's default quality for user-facing outputs (visualization and its
+# unlabeled source).
+_ENC_OPTS: Dict[str, Dict[str, List[str]]] = {
+    "libx264": {
+        "fast": ["-c:v", "libx264", "-preset", "ultrafast", "-tune", "fastdecode",
+                 "-crf", "30", "-pix_fmt", "yuv420p"],
+        "default": ["-c:v", "libx264", "-pix_fmt", "yuv420p"],
+    },
+    "h264_nvenc": {
+        "fast": ["-c:v", "h264_nvenc", "-preset", "p1", "-pix_fmt", "yuv420p"],
+        "default": ["-c:v", "h264_nvenc", "-pix_fmt", "yuv420p"],
+    },
+    "h264_videotoolbox": {
+        "fast": ["-c:v", "h264_videotoolbox", "-q:v", "65", "-pix_fmt", "yuv420p"],
+        "default": ["-c:v", "h264_videotoolbox", "-q:v", "65", "-pix_fmt", "yuv420p"],
+    },
+}
+
+
+def _detect_hw_encoder() -> str:
+    """
+    Return the first hardware H.264 encoder (NVENC, VideoToolbox) that this
+    ffmpeg can actually use, else "libx264". Builds often list NVENC without
+    a GPU being present, so each candidate is verified with a tiny encode.
+    """
+    try:
+        listing = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).stdout
+    except OSError:
+        return "libx264"
+    for encoder in ("h264_nvenc", "h264_videotoolbox"):
+        if encoder not in listing:
+            continue
+        test = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error",
+             "-f", "lavfi", "-i", "color=c=black:s=256x256:d=0.5",
+             *_ENC_OPTS[encoder]["fast"], "-f", "null", "-"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        if test.returncode == 0:
+            return encoder
+    return "libx264"
 
 
-def _make_1fps(src: str, dst: str, orig_fps: float) -> None:
-    """Re-encode src at 1 FPS keeping every original frame (setpts slowdown)."""
+def _dec_opts(encoder: str, threads: int) -> List[str]:
+    """
+    Input options. -threads 0 lets ffmpeg pick (all cores). With a hardware
+    encoder the GPU is known to work, so decode there too where possible.
+    """
+    opts = ["-threads", str(threads)]
+    if encoder != "libx264":
+        opts += ["-hwaccel", "auto"]
+    return opts
+
+
+def _enc_opts(encoder: str, threads: int, fast: bool = False) -> List[str]:
+    """Output options for a video-only H.264 output (see _ENC_OPTS)."""
+    return ["-an", *_ENC_OPTS[encoder]["fast" if fast else "default"],
+            "-threads", str(threads)]
+
+
+def _to_1fps_filter(orig_fps: Optional[float]) -> str:
+    """
+    Filter that turns the source into a 1-FPS stream. By default every frame
+    is kept and playback is slowed down by orig_fps (setpts). orig_fps=None
+    (--subsample) instead samples one frame per second of source (fps=1):
+    far less encode work, but frame indices then count seconds, not frames.
+
+    Either way the stream ends in fps=1, so the rate sync (dropping or
+    duplicating frames of variable-rate input) happens inside the graph,
+    before any label is drawn or the stream is split: every output of a
+    pass, and every pass, then numbers the same frames.
+    """
+    if orig_fps is None or orig_fps == 1.0:
+        return "fps=1"
+    return f"setpts={orig_fps}*PTS,fps=1"
+
+
+def _downscale_filter(max_width: int) -> str:
+    """Scale filter capping width at max_width (even, aspect kept); never upscales."""
+    return f"scale='trunc(min({max_width},iw)/2)*2':-2:flags=lanczos"
+
+
+def _make_1fps(
+    src: str,
+    dst: str,
+    orig_fps: Optional[float],
+    threads: int = 0,
+    encoder: str = "libx264",
+) -> None:
+    """Re-encode src at 1 FPS (see _to_1fps_filter)."""
     _run_ffmpeg([
-        "-i", src,
-        "-vf", f"setpts={orig_fps}*PTS",
+        *_dec_opts(encoder, threads), "-i", src,
+        "-vf", _to_1fps_filter(orig_fps),
         "-r", "1",
-        dst,
+        *_enc_opts(encoder, threads), dst,
     ])
 
 
-def _make_labeled(src_1fps: str, dst: str) -> None:
-    """Burn white 'Frame N' label into every frame."""
-    _run_ffmpeg(["-i", src_1fps, "-vf", _DT_BASE + ":fontcolor=white", dst])
+def _make_1fps_labeled(
+    src: str,
+    dst: str,
+    orig_fps: Optional[float],
+    unlabeled_dst: Optional[str] = None,
+    threads: int = 0,
+    encoder: str = "libx264",
+    max_width: Optional[int] = None,
+) -> None:
+    """
+    Convert src to 1 FPS (see _to_1fps_filter) and burn white 'Frame N'
+    labels in a single ffmpeg pass.
+
+    If max_width is given, the labeled video is downscaled to at most that
+    width before labeling (lossy; the label keeps its pixel size, so it stays
+    readable). If unlabeled_dst is given, the decoded 1-fps stream is split so
+    the same pass also writes a full-resolution unlabeled copy (the source for
+    the visualization).
+    """
+    slow = _to_1fps_filter(orig_fps)
+    label = _DT_BASE + ":fontcolor=white"
+    if max_width is not None:
+        label = f"{_downscale_filter(max_width)},{label}"
+    dec = _dec_opts(encoder, threads)
+    if unlabeled_dst is None:
+        _run_ffmpeg([
+            *dec, "-i", src,
+            "-vf", f"{slow},{label}", "-r", "1",
+            *_enc_opts(encoder, threads, fast=True), dst,
+        ])
+        return
+    graph = f"[0:v]{slow},split=2[a][b];[a]{label}[out1];[b]null[out2]"
+    _run_ffmpeg([
+        *dec, "-i", src,
+        "-filter_complex", graph,
+        "-map", "[out1]", "-r", "1", *_enc_opts(encoder, threads, fast=True), dst,
+        "-map", "[out2]", "-r", "1", *_enc_opts(encoder, threads), unlabeled_dst,
+    ])
+
+
+def _batch_canvas(meta: Dict[str, Any], max_width: Optional[int]) -> Tuple[int, int]:
+    """
+    Frame size of a batched labeled video: the first clip's size (from its
+    _probe metadata), capped at max_width with aspect kept, rounded to even.
+    """
+    w, h = int(meta["width"]), int(meta["height"])
+    if max_width is not None and w > max_width:
+        w, h = max_width, round(h * max_width / w)
+    return w // 2 * 2, h // 2 * 2
+
+
+def _make_batch_labeled(
+    srcs: List[str],
+    dst: str,
+    orig_fps: List[Optional[float]],
+    size: Tuple[int, int],
+    threads: int = 0,
+    encoder: str = "libx264",
+) -> None:
+    """
+    Convert each of srcs to 1 FPS (see _to_1fps_filter), label clip i with
+    white 'V{i}:Frame N' (N restarts at 0 per clip) and concatenate them into
+    a single labeled video, in one ffmpeg pass. concat needs identical frame
+    sizes, so every clip is scaled and letterboxed onto a size canvas.
+    """
+    w, h = size
+    dec = _dec_opts(encoder, threads)
+    inputs: List[str] = []
+    chains: List[str] = []
+    for i, (src, fps) in enumerate(zip(srcs, orig_fps)):
+        inputs += [*dec, "-i", src]
+        label = f"drawtext=text='V{i}\\:Frame %{{n}}'" + _DT_STYLE + ":fontcolor=white"
+        chains.append(
+            f"[{i}:v]{_to_1fps_filter(fps)},"
+            f"scale={w}:{h}:force_original_aspect_ratio=decrease:flags=lanczos,"
+            f"pad={w}:{h}:(ow-iw)/2:(oh-ih)/2,setsar=1,{label}[v{i}]"
+        )
+    concat = "".join(f"[v{i}]" for i in range(len(srcs)))
+    graph = ";".join(chains) + f";{concat}concat=n={len(srcs)}:v=1:a=0[out]"
+    _run_ffmpeg([
+        *inputs,
+        "-filter_complex", graph,
+        "-map", "[out]", "-r", "1", *_enc_opts(encoder, threads, fast=True), dst,
+    ])
 
 
 def _highlight_expr(
@@ -191,39 +481,195 @@ def _make_visualization(
     L_range: Optional[List[int]],
     R_range: Optional[List[int]],
     vis_fps: int = 10,
+    threads: int = 0,
+    encoder: str = "libx264",
 ) -> None:
     """
     Create visualization video from the unlabeled 1-fps source:
       - Normal frames              → white 'Frame N' label
       - Brush-contact range frames → red 'Frame N' label
-    Output is re-encoded at vis_fps so each original frame is held for vis_fps display frames.
+    Output plays back at vis_fps with each original frame encoded exactly once
+    (setpts speed-up), so encode work is one frame per original frame.
+
+    src_1fps may be the raw source when it already probes as 1 FPS, so it is
+    synced with fps=1 (as in _to_1fps_filter) before labeling: the frames
+    numbered here are then the frames numbered in the Gemini upload.
     """
     hi = _highlight_expr(L_range, R_range)
     if hi is None:
         # No events detected — just white labels, same as labeled video
         vf = _DT_BASE + ":fontcolor=white"
     else:
-        # Two drawtext passes: white for non-highlighted, red for highlighted.
-        # not(expr) in ffmpeg = 1 when expr==0, i.e. frame is NOT highlighted.
-        white = _DT_BASE + f":fontcolor=white:enable=not({hi})"
-        red   = _DT_BASE + f":fontcolor=red:enable={hi}"
-        vf = f"{white},{red}"
+        # Single drawtext pass with a per-frame color. fontcolor_expr is
+        # expanded like text, so %{eif:...:x:6} renders the color as RRGGBB
+        # hex: red (0xFF0000) for highlighted frames, white otherwise.
+        vf = _DT_BASE + (
+            f":fontcolor_expr='0x%{{eif\\:if(gt({hi}\\,0)\\,16711680\\,16777215)\\:x\\:6}}'"
+        )
 
-    _run_ffmpeg(["-i", src_1fps, "-vf", f"setpts=PTS/{vis_fps},{vf}", "-r", str(vis_fps), dst])
+    # Default quality since this is user-facing, but a faster x264 preset and
+    # a keyframe every 10 s of playback instead of the encoder's default GOP.
+    enc = _enc_opts(encoder, threads)
+    if encoder == "libx264":
+        enc += ["-preset", "veryfast"]
+    _run_ffmpeg([
+        *_dec_opts(encoder, threads), "-i", src_1fps,
+        "-vf", f"fps=1,setpts=PTS/{vis_fps},{vf}", "-r", str(vis_fps),
+        *enc, "-g", str(vis_fps * 10),
+        dst,
+    ])
 
 
-# ── Gemini detection ───────────────────────────────────────────────────────────
+# ── Caches ─────────────────────────────────────────────────────────────────────
 
-def _detect_brush_events(
-    video_path: str,
-    client: genai.Client,
-    model: str,
-    temperature: float = 0.0,
-) -> Dict[str, Any]:
-    uploaded = client.files.upload(file=video_path)
+def _sha256_file(path: str) -> str:
+    """Streaming sha256 of a file (OpenSSL-backed hashlib.file_digest on 3.11+)."""
+    with open(path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        h = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+        return h.hexdigest()
+
+
+def _atomic_write_bytes(path: Path, data: bytes) -> None:
+    """Write data to path via a temp file + os.replace, so readers never see a partial file."""
+    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class _CacheBackend(Protocol):
+    """Key/value store for serialized (UTF-8 JSON) Gemini results."""
+
+    def get(self, key: str) -> Optional[bytes]: ...
+
+    def set(self, key: str, value: bytes) -> None: ...
+
+
+class _FileCacheBackend:
+    """One JSON file per key under root; writes are atomic (tempfile + os.replace)."""
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return (self.root / f"{key}.json").read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key: str, value: bytes) -> None:
+        _atomic_write_bytes(self.root / f"{key}.json", value)
+
+
+class _LLMCache:
+    """
+    Gemini detection results keyed by sha256(model | prompt | video sha256).
+
+    Only meaningful at temperature 0, where the response is deterministic;
+    a hit skips upload, ACTIVE poll and generation entirely.
+    """
+
+    def __init__(self, backend: _CacheBackend) -> None:
+        self.backend = backend
+
+    @staticmethod
+    def key(model: str, prompt: str, video_sha256: str) -> str:
+        return hashlib.sha256(f"{model}|{prompt}|{video_sha256}".encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        raw = self.backend.get(key)
+        if raw is None:
+            return None
+        try:
+            return _json_loads(raw)
+        except json.JSONDecodeError:  # orjson's error subclasses it
+            return None  # corrupt entry — treat as a miss
+
+    def set(self, key: str, result: Dict[str, Any]) -> None:
+        self.backend.set(key, _json_dumps(result))
+
+
+# Gemini Files-API uploads live for 48 h server-side; only reuse well within that.
+_FILES_CACHE_TTL = 2 * 3600
+
+
+class _FilesCache:
+    """
+    Manifest of Gemini Files-API uploads keyed by content sha256, persisted as
+    JSON so a rerun after a failed detection can reuse the upload instead of
+    re-paying upload + ACTIVE wait. Safe to share between upload threads.
 
-    # Poll until ACTIVE (timeout after 5 minutes)
-    deadline = time.time() + 300
+    Identical videos within a run share one upload, so uploads are reference
+    counted: acquire() / put() take a reference, release() drops it and says
+    whether the caller was the last user (and may delete the file).
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._refs: Dict[str, int] = {}  # uploaded file name -> users in this run
+        try:
+            self._entries: Dict[str, Dict[str, Any]] = _json_loads(path.read_bytes())
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._entries = {}
+
+    def acquire(self, sha256: str) -> Optional[str]:
+        """
+        Return the uploaded file name for sha256 and take a reference on it,
+        or None if there is no unexpired entry.
+        """
+        with self._lock:
+            entry = self._entries.get(sha256)
+            if entry is None or entry["expiry"] < time.time():
+                return None
+            self._refs[entry["name"]] = self._refs.get(entry["name"], 0) + 1
+            return entry["name"]
+
+    def put(self, sha256: str, name: str) -> None:
+        """Record a new upload of sha256, referenced once by the caller."""
+        with self._lock:
+            self._entries[sha256] = {"name": name, "expiry": time.time() + _FILES_CACHE_TTL}
+            self._refs[name] = 1
+            self._save()
+
+    def release(self, sha256: str, name: str) -> bool:
+        """
+        Drop a reference on upload name. Returns True for the last reference;
+        the entry is then forgotten, so nobody else can acquire the file.
+        """
+        with self._lock:
+            refs = self._refs.get(name, 1) - 1
+            if refs > 0:
+                self._refs[name] = refs
+                return False
+            self._refs.pop(name, None)
+            entry = self._entries.get(sha256)
+            if entry is not None and entry["name"] == name:
+                del self._entries[sha256]
+                self._save()
+            return True
+
+    def _save(self) -> None:
+        _atomic_write_bytes(self.path, _json_dumps(self._entries, indent=True))
+
+
+# ── Gemini detection ───────────────────────────────────────────────────────────
+
+def _poll_active(client: genai.Client, uploaded: Any, deadline: float) -> Any:
+    """
+    Poll an uploaded file until it is ACTIVE, with exponential backoff
+    (0.5 → 1 → 2 → 4 → 8 s cap) and ±20% jitter between files.get calls.
+    """
+    delay = 0.5
     while uploaded.state.name != "ACTIVE":
         if uploaded.state.name == "FAILED":
             raise RuntimeError(f"Gemini file processing failed: {uploaded.name}")
@@ -231,21 +677,90 @@ def _detect_brush_events(
             raise RuntimeError(f"Timed out waiting for Gemini file to become ACTIVE: {uploaded.name}")
         print(f"    Waiting for Gemini file to become ACTIVE "
               f"(current: {uploaded.state.name})...", flush=True)
-        time.sleep(2)
+        time.sleep(delay * random.uniform(0.8, 1.2))
+        delay = min(delay * 2, 8.0)
         uploaded = client.files.get(name=uploaded.name)
+    return uploaded
+
+
+def _make_client(api_key: str) -> genai.Client:
+    """
+    Gemini client shared by every worker thread. The SDK keeps one pooled
+    httpx client per genai.Client; give it enough keep-alive connections for
+    the concurrent upload/poll/generate stages, and multiplex them over
+    HTTP/2 when the optional h2 package is installed.
+    """
+    client_args: Dict[str, Any] = {
+        "limits": httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    }
+    if importlib.util.find_spec("h2") is not None:
+        client_args["http2"] = True
+    return genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(client_args=client_args),
+    )
+
+
+def _upload_video(video_path: str, client: genai.Client) -> Any:
+    """Upload video_path to the Gemini Files API and wait until it is ACTIVE."""
+    uploaded = client.files.upload(file=video_path)
+    # Timeout after 5 minutes
+    return _poll_active(client, uploaded, deadline=time.time() + 300)
+
 
+def _upload_or_reuse(
+    video_path: str, client: genai.Client, cache: _FilesCache, sha256: str
+) -> Any:
+    """
+    Return an ACTIVE uploaded file for video_path (content hash sha256),
+    reusing an upload of identical content if it is still ACTIVE. Either way
+    the caller holds a reference on it (see _FilesCache.release).
+    """
+    name = cache.acquire(sha256)
+    if name is not None:
+        try:
+            uploaded = client.files.get(name=name)
+        except Exception:
+            uploaded = None  # deleted or expired server-side
+        if uploaded is not None and uploaded.state.name == "ACTIVE":
+            print(f"    Reusing Gemini upload {name}", flush=True)
+            return uploaded
+        cache.release(sha256, name)
+    uploaded = _upload_video(video_path, client)
+    cache.put(sha256, uploaded.name)
+    return uploaded
+
+
+def _gen_config(
+    temperature: float, schema: Dict[str, Any], default: types.GenerateContentConfig
+) -> types.GenerateContentConfig:
+    """The prebuilt default config at temperature 0, else a fresh one for schema."""
+    if temperature == 0.0:
+        return default
+    return types.GenerateContentConfig(
+        temperature=temperature,
+        response_mime_type="application/json",
+        response_schema=schema,
+    )
+
+
+def _generate_json(
+    video: Any,
+    client: genai.Client,
+    model: str,
+    prompt: str,
+    config: types.GenerateContentConfig,
+) -> Dict[str, Any]:
+    """
+    Call generate_content on video + prompt and parse the JSON response.
+    video is either an ACTIVE uploaded file or an inline video Part.
+    """
     # Retry generate_content on transient 503 / 429 errors with exponential backoff
     max_retries = 5
     for attempt in range(max_retries):
         try:
             resp = client.models.generate_content(
-                model=model,
-                contents=[uploaded, PROMPT_EN],
-                config=types.GenerateContentConfig(
-                    temperature=temperature,
-                    response_mime_type="application/json",
-                    response_schema=RESPONSE_SCHEMA,
-                ),
+                model=model, contents=[video, prompt], config=config,
             )
             break
         except Exception as exc:
@@ -258,17 +773,14 @@ def _detect_brush_events(
             else:
                 raise
 
-    # Best-effort cleanup of the uploaded file
     try:
-        client.files.delete(name=uploaded.name)
-    except Exception:
-        pass
-
-    try:
-        data = json.loads(resp.text)
+        return _json_loads(resp.text)
     except json.JSONDecodeError as e:
         raise RuntimeError(f"Gemini returned non-JSON:\n{resp.text}") from e
 
+
+def _validate_result(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Pick L / R / notes out of one parsed detection and type-check them."""
     result: Dict[str, Any] = {
         "L": data.get("L"),
         "R": data.get("R"),
@@ -278,110 +790,541 @@ def _detect_brush_events(
     # Type validation
     for key in ("L", "R"):
         val = result[key]
-        if val is not None:
-            if (
-                not isinstance(val, list)
-                or len(val) != 2
-                or not all(isinstance(v, int) for v in val)
-            ):
-                raise TypeError(
-                    f'Expected "{key}" to be [int, int] or null, got {val!r}'
-                )
+        if val is not None and not (
+            isinstance(val, list) and len(val) == 2 and all(isinstance(v, int) for v in val)
+        ):
+            raise TypeError(f'Expected "{key}" to be [int, int] or null, got {val!r}')
     if not isinstance(result["notes"], str):
         result["notes"] = str(result["notes"])
 
     return result
 
 
-# ── Per-video pipeline ─────────────────────────────────────────────────────────
+def _generate_brush_events(
+    video: Any,
+    client: genai.Client,
+    model: str,
+    temperature: float = 0.0,
+) -> Dict[str, Any]:
+    """Run brush-event detection on one labeled video and validate the JSON."""
+    config = _gen_config(temperature, RESPONSE_SCHEMA, _GEN_CFG)
+    data = _generate_json(video, client, model, PROMPT_EN, config)
+    return _validate_result(data)
+
+
+def _split_batch_results(data: Dict[str, Any], n_clips: int) -> List[Dict[str, Any]]:
+    """
+    Split a parsed batched response into one validated result per clip, in
+    clip order (V0, V1, ...). Raises if any clip is missing, duplicated or
+    not one of the clips in the batch (a misread label).
+    """
+    expected = [f"V{i}" for i in range(n_clips)]
+    by_id: Dict[str, Dict[str, Any]] = {}
+    for entry in data.get("results") or []:
+        video_id = str(entry.get("video_id", "")).strip()
+        if video_id not in expected:
+            raise ValueError(
+                f"Gemini returned unexpected clip id {video_id!r} "
+                f"(batch has {', '.join(expected)})"
+            )
+        if video_id in by_id:
+            raise ValueError(f"Gemini returned {video_id!r} more than once")
+        by_id[video_id] = entry
+    missing = [v for v in expected if v not in by_id]
+    if missing:
+        raise ValueError(f"Gemini returned no result for clip(s) {', '.join(missing)}")
+    return [_validate_result(by_id[v]) for v in expected]
 
-def _process_video(
-    video_path: Path,
-    output_dir: Path,
+
+def _generate_batch_brush_events(
+    video: Any,
     client: genai.Client,
     model: str,
-    temperature: float,
-    visualize: bool,
-    vis_fps: int = 10,
-    force: bool = False,
-) -> None:
-    stem = video_path.stem
-    out_sub = output_dir / stem
-    out_sub.mkdir(parents=True, exist_ok=True)
+    n_clips: int,
+    temperature: float = 0.0,
+) -> List[Dict[str, Any]]:
+    """
+    Run brush-event detection on a batched labeled video (see
+    _make_batch_labeled) of n_clips clips; returns one result per clip.
+    """
+    config = _gen_config(temperature, BATCH_RESPONSE_SCHEMA, _GEN_CFG_BATCH)
+    data = _generate_json(video, client, model, PROMPT_BATCH_EN, config)
+    return _split_batch_results(data, n_clips)
 
-    tmp_1fps    = out_sub / f"{stem}_1fps_tmp.mp4"
-    labeled_mp4 = out_sub / f"{stem}_labeled.mp4"
-    vis_mp4     = out_sub / f"{stem}_vis.mp4"
-    result_json = out_sub / "result.json"
 
-    tag = f"[{stem}]"
-    print(f"\n{'='*60}\n{tag} Processing: {video_path.name}", flush=True)
+# ── Batch pipeline ─────────────────────────────────────────────────────────────
 
-    # Determine what needs to be done
-    need_detection = force or not result_json.exists()
-    need_vis = visualize and (force or not vis_mp4.exists())
+# Pool sizes for the network-bound Gemini stages. The ffmpeg pool is sized by
+# --workers (each ffmpeg process gets cpu_count // workers threads).
+_UPLOAD_WORKERS = 8
+_GENERATE_WORKERS = 4
 
-    if not need_detection and not need_vis:
-        print(f"{tag} Already complete — skipping (use --force to reprocess).", flush=True)
-        return
+# Jobs (videos, or batches) in flight at once, per ffmpeg worker. Each keeps
+# its intermediates (labeled video, unlabeled 1-fps copy) on disk until it
+# finishes, so submit() blocks rather than queue the whole input directory.
+_IN_FLIGHT_PER_WORKER = 2
 
-    try:
-        if need_detection:
-            # Step 1 — Convert to 1 FPS if needed
-            orig_fps = _get_orig_fps(str(video_path))
-            print(f"{tag} Original FPS : {orig_fps}")
-            if orig_fps == 1.0:
-                print(f"{tag} [1/3] Already 1 FPS — skipping conversion.", flush=True)
-                src_1fps = str(video_path)
-            else:
-                print(f"{tag} [1/3] Converting to 1 FPS ...", flush=True)
-                _make_1fps(str(video_path), str(tmp_1fps), orig_fps)
-                src_1fps = str(tmp_1fps)
-
-            # Step 2 — Burn white frame-index labels (for Gemini upload)
-            print(f"{tag} [2/3] Burning frame labels ...", flush=True)
-            _make_labeled(src_1fps, str(labeled_mp4))
-
-            # Step 3 — Gemini detection
-            print(f"{tag} [3/3] Uploading to Gemini & detecting ...", flush=True)
-            result = _detect_brush_events(str(labeled_mp4), client, model, temperature)
-            print(f"{tag} L={result['L']}  R={result['R']}")
-            print(f"{tag} Notes: {result['notes']}")
-
-            # Save JSON
-            result["video"] = video_path.name
-            result_json.write_text(json.dumps(result, indent=2, ensure_ascii=False))
-            print(f"{tag} Saved: {result_json}")
+# --inline-if-small threshold. Gemini caps inline requests at 20 MB, and the
+# video is base64-encoded in the request body (4/3 inflation).
+_INLINE_MAX_BYTES = 20 * 1024 * 1024 * 3 // 4
+
+# A stage returns the next (pool, stage) to run for the job, or None when done.
+_NextStage = Optional[Tuple[concurrent.futures.Executor, Callable[[Any], Any]]]
+
+
+@dataclass
+class _Job:
+    """State of one video as it moves through the pipeline stages."""
+
+    video_path: Path
+    out_sub: Path
+    need_detection: bool
+    need_vis: bool
+    src_1fps: Optional[str] = None
+    uploaded: Any = None
+    inline_part: Any = None
+    video_sha256: Optional[str] = None
+    cache_key: Optional[str] = None
+    result: Optional[Dict[str, Any]] = None
+    done: concurrent.futures.Future = field(default_factory=concurrent.futures.Future)
+
+    @property
+    def tag(self) -> str:
+        return f"[{self.video_path.stem}]"
+
+    @property
+    def tmp_1fps(self) -> Path:
+        return self.out_sub / f"{self.video_path.stem}_1fps_tmp.mp4"
+
+    @property
+    def labeled_mp4(self) -> Path:
+        return self.out_sub / f"{self.video_path.stem}_labeled.mp4"
+
+    @property
+    def vis_mp4(self) -> Path:
+        return self.out_sub / f"{self.video_path.stem}_vis.mp4"
+
+    @property
+    def result_json(self) -> Path:
+        return self.out_sub / "result.json"
+
+    def cleanup(self) -> None:
+        # Always clean up intermediates
+        if self.tmp_1fps.exists():
+            self.tmp_1fps.unlink()
+        if self.labeled_mp4.exists():
+            self.labeled_mp4.unlink()
+
+
+@dataclass
+class _Batch:
+    """
+    Several videos (--batch-size) detected in one Gemini request. Goes through
+    the upload and generate stages like a _Job; each member _Job is then
+    finished (or visualized) on its own.
+    """
+
+    jobs: List[_Job]
+    labeled_mp4: Path
+    uploaded: Any = None
+    inline_part: Any = None
+    video_sha256: Optional[str] = None
+    cache_key: Optional[str] = None
+    done: concurrent.futures.Future = field(default_factory=concurrent.futures.Future)
+
+    @property
+    def tag(self) -> str:
+        return f"[batch {self.jobs[0].video_path.stem} +{len(self.jobs) - 1}]"
+
+    def cleanup(self) -> None:
+        if self.labeled_mp4.exists():
+            self.labeled_mp4.unlink()
+
+
+class _Pipeline:
+    """
+    Staged batch pipeline: ffmpeg preprocess → Gemini upload + ACTIVE poll →
+    Gemini generate (→ ffmpeg visualization).
+
+    Each stage runs in its own thread pool, so the upload of video N overlaps
+    with the ffmpeg pass of video N+1 and the generation of video N-1. A stage
+    hands its job to the next pool from a done-callback, so no worker ever
+    blocks waiting on another stage. submit() returns a future that resolves
+    when the job has finished (or failed) all of its stages; submit_batch()
+    returns one such future per video. Both block while ffmpeg_workers *
+    _IN_FLIGHT_PER_WORKER jobs are already in flight.
+    """
+
+    def __init__(
+        self,
+        output_dir: Path,
+        client: genai.Client,
+        model: str,
+        temperature: float,
+        visualize: bool,
+        vis_fps: int = 10,
+        force: bool = False,
+        ff_threads: int = 0,
+        ffmpeg_workers: int = 4,
+        encoder: str = "libx264",
+        max_width: Optional[int] = None,
+        llm_cache: Optional[_LLMCache] = None,
+        files_cache: Optional[_FilesCache] = None,
+        inline_if_small: bool = False,
+        subsample: bool = False,
+    ) -> None:
+        self.output_dir = output_dir
+        self.client = client
+        self.model = model
+        self.temperature = temperature
+        self.visualize = visualize
+        self.vis_fps = vis_fps
+        self.force = force
+        self.ff_threads = ff_threads
+        self.encoder = encoder
+        self.max_width = max_width
+        self.llm_cache = llm_cache
+        self.files_cache = files_cache
+        self.inline_if_small = inline_if_small
+        self.subsample = subsample
+        self.n_skipped = 0
+        self._slots = threading.BoundedSemaphore(ffmpeg_workers * _IN_FLIGHT_PER_WORKER)
+        self._ffmpeg_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=ffmpeg_workers, thread_name_prefix="ffmpeg")
+        self._upload_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=_UPLOAD_WORKERS, thread_name_prefix="upload")
+        self._generate_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=_GENERATE_WORKERS, thread_name_prefix="generate")
+
+    def submit(self, video_path: Path) -> concurrent.futures.Future:
+        """
+        Schedule video_path and return its completion future. Videos whose
+        outputs already exist (and --force is off) are skipped right here,
+        without occupying a pool or in-flight slot; the future is then
+        already resolved.
+        """
+        job = self._new_job(video_path)
+        self._submit_job(job)
+        return job.done
+
+    def submit_batch(self, video_paths: List[Path]) -> List[concurrent.futures.Future]:
+        """
+        Like submit(), but the videos that need detection are concatenated
+        into one labeled video and detected in a single Gemini request.
+        Returns one completion future per video, in order.
+        """
+        jobs = [self._new_job(video_path) for video_path in video_paths]
+        detect = [job for job in jobs if job.need_detection]
+        for job in jobs:
+            if not job.need_detection:
+                self._submit_job(job)
+        if detect:
+            stem = detect[0].video_path.stem
+            batch = _Batch(jobs=detect, labeled_mp4=self.output_dir / f".batch_{stem}_labeled.mp4")
+            batch.done.add_done_callback(lambda f: self._fail_members(batch, f))
+            self._hold_slot([job.done for job in detect])
+            self._schedule(self._ffmpeg_pool, self._stage_ffmpeg_batch, batch)
+        return [job.done for job in jobs]
+
+    def shutdown(self) -> None:
+        for pool in (self._ffmpeg_pool, self._upload_pool, self._generate_pool):
+            pool.shutdown(wait=True)
+
+    def _new_job(self, video_path: Path) -> _Job:
+        out_sub = self.output_dir / video_path.stem
+        result_json = out_sub / "result.json"
+        vis_mp4 = out_sub / f"{video_path.stem}_vis.mp4"
+        return _Job(
+            video_path=video_path,
+            out_sub=out_sub,
+            need_detection=self.force or not result_json.exists(),
+            need_vis=self.visualize and (self.force or not vis_mp4.exists()),
+        )
+
+    def _submit_job(self, job: _Job) -> None:
+        if not job.need_detection and not job.need_vis:
+            print(f"{job.tag} Already complete — skipping (use --force to reprocess).", flush=True)
+            self.n_skipped += 1
+            job.done.set_result(None)
+            return
+        self._hold_slot([job.done])
+        self._schedule(self._ffmpeg_pool, self._stage_ffmpeg, job)
+
+    def _hold_slot(self, futures: List[concurrent.futures.Future]) -> None:
+        """Wait for a free in-flight slot; it is released once all of futures are done."""
+        self._slots.acquire()
+        pending = [len(futures)]
+        lock = threading.Lock()
+
+        def release(_: concurrent.futures.Future) -> None:
+            with lock:
+                pending[0] -= 1
+                last = pending[0] == 0
+            if last:
+                self._slots.release()
+
+        for future in futures:
+            future.add_done_callback(release)
+
+    # ── scheduling ──
+
+    def _schedule(
+        self,
+        pool: concurrent.futures.Executor,
+        stage: Callable[[Any], _NextStage],
+        job: Union[_Job, _Batch],
+    ) -> None:
+        future = pool.submit(stage, job)
+        future.add_done_callback(lambda f: self._advance(job, f))
+
+    def _advance(self, job: Union[_Job, _Batch], future: concurrent.futures.Future) -> None:
+        try:
+            nxt = future.result()
+            if nxt is not None:
+                self._schedule(*nxt, job)
+                return
+        except BaseException as exc:
+            self._finish(job, exc)
+            return
+        self._finish(job)
+
+    @staticmethod
+    def _finish(job: Union[_Job, _Batch], exc: Optional[BaseException] = None) -> None:
+        job.cleanup()
+        if exc is not None:
+            job.done.set_exception(exc)
         else:
+            job.done.set_result(None)
+
+    def _fail_members(self, batch: _Batch, future: concurrent.futures.Future) -> None:
+        # A failed batch fails every member that has not been handed off yet
+        exc = future.exception()
+        if exc is None:
+            return
+        for job in batch.jobs:
+            if not job.done.done():
+                self._finish(job, exc)
+
+    def _orig_fps(self, video_path: str) -> Optional[float]:
+        """Source FPS for the setpts slowdown; None in --subsample mode (no probe needed)."""
+        if self.subsample:
+            return None
+        return float(Fraction(_probe(video_path)["r_frame_rate"]))
+
+    def _render(self, tag: str, render: Callable[..., None], *args: Any, **kwargs: Any) -> None:
+        """
+        Run an ffmpeg render helper with the configured encoder. A hardware
+        encoder verified at startup can still fail for a single job, e.g. when
+        several --workers exceed a consumer GPU's cap on concurrent NVENC
+        sessions; that job is then re-rendered with libx264.
+        """
+        try:
+            render(*args, encoder=self.encoder, **kwargs)
+        except RuntimeError as exc:
+            if self.encoder == "libx264":
+                raise
+            print(f"{tag} [WARN] {self.encoder} failed, retrying with libx264: {exc}",
+                  file=sys.stderr, flush=True)
+            render(*args, encoder="libx264", **kwargs)
+
+    # ── stages ──
+
+    def _stage_ffmpeg(self, job: _Job) -> _NextStage:
+        tag = job.tag
+        print(f"\n{'='*60}\n{tag} Processing: {job.video_path.name}", flush=True)
+        job.out_sub.mkdir(parents=True, exist_ok=True)
+
+        if not job.need_detection:
             print(f"{tag} result.json exists — skipping Gemini detection.", flush=True)
-            result = json.loads(result_json.read_text())
-            src_1fps = None  # not needed if detection is skipped
+            job.result = _json_loads(job.result_json.read_bytes())
+            return self._stage_visualize(job)  # need_vis; already on the ffmpeg pool
+
+        # Step 1 — Convert to 1 FPS and burn white frame-index labels
+        # (for Gemini upload) in one pass. The unlabeled 1-fps copy is
+        # only written when the visualization needs it.
+        video_path = str(job.video_path)
+        orig_fps = self._orig_fps(video_path)
+        if orig_fps is not None:
+            print(f"{tag} Original FPS : {orig_fps}")
+        if orig_fps == 1.0 or not job.need_vis:
+            job.src_1fps = video_path if orig_fps == 1.0 else None
+            print(f"{tag} [1/3] Converting to 1 FPS & burning frame labels ...", flush=True)
+            self._render(
+                tag, _make_1fps_labeled, video_path, str(job.labeled_mp4), orig_fps,
+                threads=self.ff_threads, max_width=self.max_width,
+            )
+        else:
+            print(f"{tag} [1/3] Converting to 1 FPS & burning frame labels "
+                  f"(+ unlabeled copy for vis) ...", flush=True)
+            self._render(
+                tag, _make_1fps_labeled, video_path, str(job.labeled_mp4), orig_fps,
+                unlabeled_dst=str(job.tmp_1fps), threads=self.ff_threads,
+                max_width=self.max_width,
+            )
+            job.src_1fps = str(job.tmp_1fps)
+
+        # Hash the labeled video once; both caches key on its content
+        if self.llm_cache is not None or self.files_cache is not None:
+            job.video_sha256 = _sha256_file(str(job.labeled_mp4))
+        if self.llm_cache is not None:
+            job.cache_key = _LLMCache.key(self.model, PROMPT_EN, job.video_sha256)
+            # --force asks for a fresh detection; the cache is only refreshed
+            cached = None if self.force else self.llm_cache.get(job.cache_key)
+            if cached is not None:
+                print(f"{tag} Cached Gemini result found — skipping upload & detection.", flush=True)
+                return self._save_result(job, cached)
+        return self._upload_pool, self._stage_upload
+
+    def _stage_ffmpeg_batch(self, batch: _Batch) -> _NextStage:
+        tag = batch.tag
+        names = ", ".join(job.video_path.name for job in batch.jobs)
+        print(f"\n{'='*60}\n{tag} Processing: {names}", flush=True)
+        for job in batch.jobs:
+            job.out_sub.mkdir(parents=True, exist_ok=True)
+
+        # Step 1 — Convert every video to 1 FPS, burn 'V{i}:Frame N' labels and
+        # concatenate them into one labeled video. The unlabeled 1-fps sources
+        # for the visualizations are rendered later, per video.
+        srcs = [str(job.video_path) for job in batch.jobs]
+        metas = [_probe(src) for src in srcs]
+        orig_fps = [
+            None if self.subsample else float(Fraction(meta["r_frame_rate"]))
+            for meta in metas
+        ]
+        print(f"{tag} [1/3] Converting {len(srcs)} video(s) to 1 FPS, burning "
+              f"labels & concatenating ...", flush=True)
+        self._render(
+            tag, _make_batch_labeled, srcs, str(batch.labeled_mp4), orig_fps,
+            _batch_canvas(metas[0], self.max_width), threads=self.ff_threads,
+        )
 
-        # Optional visualization
-        if need_vis:
-            if src_1fps is None:
-                # Detection was skipped; still need the 1-fps source for vis
-                orig_fps = _get_orig_fps(str(video_path))
-                if orig_fps == 1.0:
-                    src_1fps = str(video_path)
-                else:
-                    _make_1fps(str(video_path), str(tmp_1fps), orig_fps)
-                    src_1fps = str(tmp_1fps)
-            print(f"{tag} [vis] Generating visualization video ({vis_fps} FPS) ...", flush=True)
-            _make_visualization(
-                src_1fps, str(vis_mp4),
-                result["L"], result["R"], vis_fps,
+        if self.llm_cache is not None or self.files_cache is not None:
+            batch.video_sha256 = _sha256_file(str(batch.labeled_mp4))
+        if self.llm_cache is not None:
+            batch.cache_key = _LLMCache.key(self.model, PROMPT_BATCH_EN, batch.video_sha256)
+            cached = None if self.force else self.llm_cache.get(batch.cache_key)
+            if cached is not None:
+                print(f"{tag} Cached Gemini result found — skipping upload & detection.", flush=True)
+                return self._save_batch_results(batch, cached["results"])
+        return self._upload_pool, self._stage_upload
+
+    def _stage_upload(self, job: Union[_Job, _Batch]) -> _NextStage:
+        # Step 2 — Upload to Gemini and wait until the file is ACTIVE, or
+        # (--inline-if-small) send small videos inline with the request
+        size = job.labeled_mp4.stat().st_size
+        if self.inline_if_small and size < _INLINE_MAX_BYTES:
+            print(f"{job.tag} [2/3] Inlining video ({size / 2**20:.1f} MB) — "
+                  f"skipping Files API upload ...", flush=True)
+            job.inline_part = types.Part.from_bytes(
+                data=job.labeled_mp4.read_bytes(), mime_type="video/mp4",
+            )
+            return self._generate_pool, self._stage_generate
+
+        print(f"{job.tag} [2/3] Uploading to Gemini ...", flush=True)
+        if self.files_cache is not None:
+            job.uploaded = _upload_or_reuse(
+                str(job.labeled_mp4), self.client, self.files_cache, job.video_sha256,
+            )
+        else:
+            job.uploaded = _upload_video(str(job.labeled_mp4), self.client)
+        return self._generate_pool, self._stage_generate
+
+    def _stage_generate(self, job: Union[_Job, _Batch]) -> _NextStage:
+        # Step 3 — Gemini detection
+        tag = job.tag
+        print(f"{tag} [3/3] Detecting brush events ...", flush=True)
+        video = job.inline_part if job.inline_part is not None else job.uploaded
+        if isinstance(job, _Batch):
+            result: Any = _generate_batch_brush_events(
+                video, self.client, self.model, len(job.jobs), self.temperature,
+            )
+        else:
+            result = _generate_brush_events(
+                video, self.client, self.model, self.temperature,
             )
-            print(f"{tag} Saved: {vis_mp4}")
-        elif visualize:
+        job.inline_part = None  # release the video bytes
+
+        # Best-effort cleanup of the uploaded file, once no other job of this
+        # run still uses it. It is only kept (and left in the files cache) when
+        # detection fails, so a rerun can reuse it.
+        if job.uploaded is not None and (
+            self.files_cache is None
+            or self.files_cache.release(job.video_sha256, job.uploaded.name)
+        ):
+            try:
+                self.client.files.delete(name=job.uploaded.name)
+            except Exception:
+                pass
+
+        if isinstance(job, _Batch):
+            self._cache_result(job, {"results": result})
+            return self._save_batch_results(job, result)
+        self._cache_result(job, result)
+        return self._save_result(job, result)
+
+    def _cache_result(self, job: Union[_Job, _Batch], value: Dict[str, Any]) -> None:
+        # Best-effort: the cache is optional and must not fail a paid detection
+        if job.cache_key is None:
+            return
+        try:
+            self.llm_cache.set(job.cache_key, value)
+        except Exception as exc:
+            print(f"{job.tag} [WARN] Could not cache Gemini result: {exc}",
+                  file=sys.stderr, flush=True)
+
+    def _save_batch_results(self, batch: _Batch, results: List[Dict[str, Any]]) -> _NextStage:
+        # Hand each member off: save its result.json, then visualize or finish it.
+        # From here on a failure only fails that member, not the whole batch.
+        for job, result in zip(batch.jobs, results):
+            try:
+                nxt = self._save_result(job, result)
+                if nxt is not None:
+                    self._schedule(*nxt, job)
+                    continue
+            except Exception as exc:
+                self._finish(job, exc)
+                continue
+            self._finish(job)
+        return None
+
+    def _save_result(self, job: _Job, result: Dict[str, Any]) -> _NextStage:
+        tag = job.tag
+        print(f"{tag} L={result['L']}  R={result['R']}")
+        print(f"{tag} Notes: {result['notes']}")
+
+        # Save JSON
+        result["video"] = job.video_path.name
+        job.result_json.write_bytes(_json_dumps(result, indent=True))
+        print(f"{tag} Saved: {job.result_json}")
+        job.result = result
+
+        if job.need_vis:
+            return self._ffmpeg_pool, self._stage_visualize
+        if self.visualize:
             print(f"{tag} vis video exists — skipping visualization.", flush=True)
+        return None
 
-    finally:
-        # Always clean up intermediates
-        if tmp_1fps.exists():
-            tmp_1fps.unlink()
-        if labeled_mp4.exists():
-            labeled_mp4.unlink()
+    def _stage_visualize(self, job: _Job) -> _NextStage:
+        # Optional visualization
+        tag = job.tag
+        if job.src_1fps is None:
+            # Detection was skipped; still need the 1-fps source for vis
+            orig_fps = self._orig_fps(str(job.video_path))
+            if orig_fps == 1.0:
+                job.src_1fps = str(job.video_path)
+            else:
+                self._render(
+                    tag, _make_1fps, str(job.video_path), str(job.tmp_1fps), orig_fps,
+                    threads=self.ff_threads,
+                )
+                job.src_1fps = str(job.tmp_1fps)
+        print(f"{tag} [vis] Generating visualization video ({self.vis_fps} FPS) ...", flush=True)
+        self._render(
+            tag, _make_visualization, job.src_1fps, str(job.vis_mp4),
+            job.result["L"], job.result["R"], self.vis_fps, threads=self.ff_threads,
+        )
+        print(f"{tag} Saved: {job.vis_mp4}")
+        return None
 
 
 # ── CLI ────────────────────────────────────────────────────────────────────────
@@ -416,13 +1359,53 @@ def main() -> None:
     )
     parser.add_argument(
         "--workers", type=int, default=4,
-        help="Number of videos to process in parallel (default: 4).",
+        help="Number of videos preprocessed by ffmpeg in parallel (default: 4). "
+             "Gemini uploads and generation run in their own pools alongside.",
+    )
+    parser.add_argument(
+        "--max-width", type=int, default=720,
+        help="Downscale the video sent to Gemini to at most this width "
+             "(default: 720). Lossy, but cuts upload size and inference cost; "
+             "the visualization keeps full resolution.",
+    )
+    parser.add_argument(
+        "--no-downscale", action="store_true",
+        help="Send the video to Gemini at full resolution (overrides --max-width).",
+    )
+    parser.add_argument(
+        "--hw-encode", action="store_true",
+        help="Encode with a hardware H.264 encoder (NVIDIA NVENC or Apple "
+             "VideoToolbox) if one works on this machine; falls back to libx264.",
+    )
+    parser.add_argument(
+        "--subsample", action="store_true",
+        help="Sample one frame per second of source video instead of keeping every "
+             "frame. Much faster on high-FPS input, but frames in between are "
+             "dropped and reported indices count seconds, not original frames. "
+             "Use --force when switching modes on existing results.",
+    )
+    parser.add_argument(
+        "--inline-if-small", action="store_true",
+        help="Send labeled videos under ~15 MB inline with the Gemini request "
+             "instead of via the Files API upload (benchmark option; default off).",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=1,
+        help="Detect up to this many videos (consecutive by file name) in one "
+             "Gemini request, concatenated into a single labeled video "
+             "(default: 1 = one request per video). Cuts per-request overhead "
+             "when each labeled video is short. Sizes are in 1-FPS frames: one "
+             "per source frame by default (a 30 s clip at 30 FPS is 900 frames, "
+             "15 min of video), one per source second with --subsample.",
     )
     parser.add_argument(
         "--force", action="store_true",
-        help="Reprocess all videos, ignoring any existing results.",
+        help="Reprocess all videos, ignoring any existing results and cached "
+             "Gemini answers (the cache is refreshed with the new ones).",
     )
     args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
 
     input_dir  = Path(args.input_dir)
     output_dir = Path(args.output_dir)
@@ -432,11 +1415,16 @@ def main() -> None:
         sys.exit(1)
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    # Collect video files (sorted)
-    videos = sorted(
-        p for p in input_dir.iterdir()
-        if p.is_file() and p.suffix.lower() in VIDEO_EXTENSIONS
-    )
+    # Collect video files (sorted). scandir's DirEntry caches the file type,
+    # avoiding a stat per entry on large directories.
+    with os.scandir(input_dir) as it:
+        videos = sorted(
+            (
+                Path(e.path) for e in it
+                if e.is_file() and os.path.splitext(e.name)[1].lower() in VIDEO_EXTENSIONS
+            ),
+            key=lambda p: p.name,
+        )
     if not videos:
         print(f"[ERROR] No video files found in {input_dir}", file=sys.stderr)
         sys.exit(1)
@@ -447,34 +1435,69 @@ def main() -> None:
     if not api_key:
         print("[ERROR] Missing GEMINI_API_KEY env var.", file=sys.stderr)
         sys.exit(1)
-    client = genai.Client(api_key=api_key)
+    client = _make_client(api_key)
+
+    # Split the cores between workers so concurrent ffmpeg processes don't
+    # oversubscribe the CPU. Threads (not processes) are enough for the
+    # workers: ffmpeg runs in subprocesses and Gemini calls are network-bound,
+    # neither holds the GIL.
+    ff_threads = max(1, (os.cpu_count() or 1) // args.workers)
+
+    encoder = _detect_hw_encoder() if args.hw_encode else "libx264"
+    if args.hw_encode:
+        print(f"Video encoder: {encoder}")
 
     # Process videos in parallel, collecting errors without aborting the batch
     errors: List[str] = []
-    print(f"Processing {len(videos)} video(s) with {args.workers} parallel worker(s).")
-    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
-        future_to_video = {
-            executor.submit(
-                _process_video,
-                video_path, output_dir,
-                client, args.model, args.temperature,
-                args.visualize, args.vis_fps, args.force,
-            ): video_path
-            for video_path in videos
-        }
-        for future in concurrent.futures.as_completed(future_to_video):
-            video_path = future_to_video[future]
-            try:
-                future.result()
-            except Exception as exc:
-                msg = f"{video_path.name}: {exc}"
-                print(f"[ERROR] {msg}", file=sys.stderr)
-                errors.append(msg)
+    print(f"Processing {len(videos)} video(s) with {args.workers} parallel worker(s) "
+          f"({ff_threads} ffmpeg thread(s) each).")
+    # Gemini results are only deterministic (and thus cacheable) at temperature 0
+    llm_cache = None
+    if args.temperature == 0.0:
+        llm_cache = _LLMCache(_FileCacheBackend(output_dir / ".cache"))
+
+    pipeline = _Pipeline(
+        output_dir, client, args.model, args.temperature,
+        args.visualize, args.vis_fps, args.force, ff_threads,
+        ffmpeg_workers=args.workers, encoder=encoder,
+        max_width=None if args.no_downscale else args.max_width, llm_cache=llm_cache,
+        files_cache=_FilesCache(output_dir / ".files_cache.json"),
+        inline_if_small=args.inline_if_small,
+        subsample=args.subsample,
+    )
+
+    def report(video_path: Path, future: concurrent.futures.Future) -> None:
+        # Runs as each video finishes, while main() may still be blocked in submit
+        exc = future.exception()
+        if exc is not None:
+            msg = f"{video_path.name}: {exc}"
+            print(f"[ERROR] {msg}", file=sys.stderr)
+            errors.append(msg)
+
+    # submit() / submit_batch() block while the pipeline is full, so
+    # videos are only scheduled as earlier ones finish
+    futures: List[concurrent.futures.Future] = []
+    try:
+        if args.batch_size > 1:
+            for i in range(0, len(videos), args.batch_size):
+                group = videos[i:i + args.batch_size]
+                for video_path, future in zip(group, pipeline.submit_batch(group)):
+                    future.add_done_callback(functools.partial(report, video_path))
+                    futures.append(future)
+        else:
+            for video_path in videos:
+                future = pipeline.submit(video_path)
+                future.add_done_callback(functools.partial(report, video_path))
+                futures.append(future)
+        concurrent.futures.wait(futures)
+    finally:
+        pipeline.shutdown()
 
     # Summary
     print(f"\n{'='*60}")
     n_ok = len(videos) - len(errors)
-    print(f"Done. {n_ok}/{len(videos)} video(s) succeeded.")
+    skipped = f" ({pipeline.n_skipped} already complete)" if pipeline.n_skipped else ""
+    print(f"Done. {n_ok}/{len(videos)} video(s) succeeded{skipped}.")
     if errors:
         print("Failed:")
         for err in errors: